@@ -1,16 +1,26 @@
+import atexit
+from copy import copy
+from email.utils import parseaddr, formatdate
 from hashlib import md5
-from smtplib import SMTP, SMTP_SSL, SMTPException
+from smtplib import (SMTP, SMTP_SSL, SMTPException, SMTPServerDisconnected,
+                     SMTPResponseException, SMTPRecipientsRefused)
 from logging import getLogger
 from collections import defaultdict
-from socket import sslerror
-from threading import Lock
+from contextlib import contextmanager
+from socket import sslerror, error as socket_error
+from threading import Lock, Thread, local
+from time import time
+from Queue import Queue, Empty
 from django.core.exceptions import ImproperlyConfigured
 from django.core.mail.backends.base import BaseEmailBackend
 from django.core.mail.utils import DNS_NAME
-from django.core.mail.message import sanitize_address
+from django.core.mail.message import sanitize_address, make_msgid
 from django.conf import settings
 from django_ztaskq.decorators import ztask
-from .utils import get_setting
+from .utils import get_setting, default_settings
+from .classification import classify, PERMANENT, TRANSIENT
+from .models import DeadLetter
+from .mx import MXCache, get_resolver
 
 
 class MalformedMessage(Exception):
@@ -28,6 +38,11 @@ class MalformedMessage(Exception):
 
 class MessageWrapper(object):
 
+    # Defaults for wrappers pickled by earlier versions
+    outcome = None
+    retry_policies = None
+    envelope_recipients = None
+
     def __init__(self, message):
         self.mail_message = message
         self.retries = 0
@@ -36,10 +51,50 @@ class MessageWrapper(object):
         self.max_retries = get_setting('MAX_RETRIES')
         self.retry_step = get_setting('RETRY_STEP')
         self.retry_base = get_setting('RETRY_BASE')
+        self.retry_policies = get_setting('RETRY_POLICIES')
+        self.outcome = None
+        # The addresses the message is actually delivered to, if only
+        # a part of its recipients (see split_by_domain)
+        self.envelope_recipients = None
+
+    def recipients(self):
+        if self.envelope_recipients is not None:
+            return self.envelope_recipients
+        return self.mail_message.recipients()
+
+    def split_by_domain(self):
+        """Returns a list of ``(domain, wrapper)`` tuples, one for each
+        domain among the recipients, sharing the same message
+        """
+        domains = defaultdict(list)
+        for addr in self.recipients():
+            domain = parseaddr(addr)[1].rpartition('@')[2].lower()
+            domains[domain].append(addr)
+        if len(domains) == 1:
+            return [ (domain, self) for domain in domains ]
+        # Django makes up a new Date and Message-ID each time the message
+        # is rendered, but all the parts must share the same ones
+        mail_message = self.mail_message
+        header_names = [ key.lower() for key in mail_message.extra_headers ]
+        if 'date' not in header_names or 'message-id' not in header_names:
+            mail_message = copy(mail_message)
+            mail_message.extra_headers = dict(mail_message.extra_headers)
+            if 'date' not in header_names:
+                mail_message.extra_headers['Date'] = formatdate()
+            if 'message-id' not in header_names:
+                mail_message.extra_headers['Message-ID'] = make_msgid()
+        parts = []
+        for domain, recipients in domains.items():
+            part = copy(self)
+            part.mail_message = mail_message
+            part.errors = list(self.errors)
+            part.envelope_recipients = recipients
+            parts.append((domain, part))
+        return parts
 
     def send(self, connection):
         email_message = self.mail_message
-        if not email_message.recipients():
+        if not self.recipients():
             raise MalformedMessage("No recipients for message", email_message)
         from_email = sanitize_address(
             email_message.from_email,
@@ -47,7 +102,7 @@ class MessageWrapper(object):
         )
         recipients = [
             sanitize_address(addr, email_message.encoding)
-            for addr in email_message.recipients()
+            for addr in self.recipients()
         ]
         try:
             connection.sendmail(
@@ -56,18 +111,37 @@ class MessageWrapper(object):
                 email_message.message().as_string()
             )
         except SMTPException, e: # pylint: disable=W0703
-            self.retries += 1
-            self.errors.append(e)
+            self.fail(e)
         else:
             self.sent = True
 
+    def fail(self, error, outcome=None):
+        self.retries += 1
+        self.errors.append(error)
+        if outcome is None:
+            outcome = classify(error)
+        self.outcome = outcome
+
+    def get_policy(self, name):
+        policies = self.retry_policies
+        if policies is None:
+            policies = get_setting('RETRY_POLICIES')
+        # RETRY_POLICIES overrides the default policies key by key
+        for policy in (policies, default_settings['RETRY_POLICIES']):
+            policy = policy.get(self.outcome, {})
+            if name in policy:
+                return policy[name]
+        return getattr(self, name.lower())
+
     def must_resend(self):
-        if not self.sent and self.retries <= self.max_retries:
+        if not self.sent and self.retries <= self.get_policy('MAX_RETRIES'):
             return True
         return False
 
     def resend_wait(self):
-        return self.retry_step * (self.retry_base ** (self.retries - 1))
+        return self.get_policy('RETRY_STEP') * (
+            self.get_policy('RETRY_BASE') ** (self.retries - 1)
+        )
 
     @property
     def uid(self):
@@ -79,7 +153,7 @@ class MessageWrapper(object):
     def __repr__(self):
         return "<MessageWrapper: from '%s' to '%s' (%s), retried %d>" % (
             self.mail_message.from_email,
-            ", ".join(self.mail_message.recipients()),
+            ", ".join(self.recipients()),
             self.uid,
             self.retries
         )
@@ -100,9 +174,18 @@ class MailSender(object):
                 "You must set either EMAIL_USE_SMTP_SSL or "
                 "EMAIL_USE_TLS, not both"
             )
+        self.max_reconnects = get_setting('MAX_RECONNECTS')
+        self.direct = get_setting('DIRECT_DELIVERY')
+        self.mx_port = get_setting('MX_PORT')
+        self.mx_timeout = get_setting('MX_TIMEOUT')
+        self.mx_cache = None
+        if self.direct:
+            self.mx_cache = MXCache(get_resolver())
+        self.mx_host = None
         self.connection = None
 
     def connect(self):
+        self.mx_host = None
         kwargs = {
             'local_hostname': DNS_NAME.get_fqdn()
         }
@@ -124,15 +207,85 @@ class MailSender(object):
             self.connection.login(self.username, self.password)
         return True
 
+    def connect_mx(self, host):
+        """Connects to a mail exchanger, using TLS if it supports it.
+        A timeout raises ``socket.timeout``, a ``socket.error``.
+        """
+        self.mx_host = host
+        connection = SMTP(
+            host,
+            self.mx_port,
+            local_hostname=DNS_NAME.get_fqdn(),
+            timeout=self.mx_timeout
+        )
+        try:
+            connection.ehlo()
+            if connection.has_extn('starttls'):
+                connection.starttls()
+                connection.ehlo()
+        except:
+            connection.close()
+            raise
+        self.connection = connection
+        return True
+
     def disconnect(self):
         if self.connection is not None:
             try:
                 self.connection.quit()
-            except sslerror:
+            except (sslerror, SMTPServerDisconnected):
                 # This happens when calling quit() on a TLS connection
-                # sometimes.
+                # sometimes, or when the server already hung up.
                 self.connection.close()
 
+    def reconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+        if self.mx_host is not None:
+            return self.connect_mx(self.mx_host)
+        return self.connect()
+
+    def session_lost(self, message):
+        """Tells whether sending ``message`` failed because the server
+        dropped the connection, rather than because of the message itself
+        """
+        if message.sent or not message.errors:
+            return False
+        error = message.errors[-1]
+        if isinstance(error, SMTPServerDisconnected):
+            return True
+        return (isinstance(error, SMTPResponseException) and
+                error.smtp_code == 421)
+
+    def defer(self, messages, error, results):
+        # The error is about the session rather than the messages,
+        # so it can't make them permanently undeliverable
+        outcome = classify(error)
+        if outcome == PERMANENT:
+            outcome = TRANSIENT
+        for message in messages:
+            message.fail(error, outcome)
+            results['retry'].append(message)
+
+    def send_all(self, messages, results):
+        reconnects = 0
+        for index, message in enumerate(messages):
+            self.send_message(message, results)
+            if index + 1 == len(messages) or not self.session_lost(message):
+                continue
+            remaining = messages[index + 1:]
+            # Only the message that was being sent when the server went
+            # away is charged a retry, the others go on a fresh session
+            if reconnects >= self.max_reconnects:
+                self.defer(remaining, message.errors[-1], results)
+                break
+            reconnects += 1
+            try:
+                self.reconnect()
+            except (SMTPException, socket_error), e:
+                self.defer(remaining, e, results)
+                break
+
     def send_message(self, message, results):
         try:
             message.send(self.connection)
@@ -145,6 +298,60 @@ class MailSender(object):
             else:
                 results['retry'].append(message)
 
+    def deliver(self, messages, results):
+        try:
+            self.connect()
+        except (SMTPException, socket_error), e:
+            self.defer(messages, e, results)
+        else:
+            self.send_all(messages, results)
+        self.disconnect()
+
+    def deliver_direct(self, messages, results):
+        """Delivers each message straight to the mail exchangers of its
+        recipients' domains, with a connection for each set of exchangers
+        """
+        routes = defaultdict(list)
+        for message in messages:
+            if not message.recipients():
+                message.errors.append(MalformedMessage(
+                    "No recipients for message",
+                    message.mail_message
+                ))
+                results['failed'].append(message)
+                continue
+            for domain, part in message.split_by_domain():
+                try:
+                    hosts = self.mx_cache.get_hosts(domain) if domain else []
+                except Exception, e: # pylint: disable=W0703
+                    self.defer([ part ], e, results)
+                    continue
+                if hosts:
+                    routes[tuple(hosts)].append(part)
+                    continue
+                part.fail(SMTPRecipientsRefused(dict(
+                    (addr, (556, "5.1.10 No mail exchanger for '%s'" % (
+                        domain,
+                    )))
+                    for addr in part.recipients()
+                )))
+                results['retry'].append(part)
+        for hosts, group in routes.items():
+            self.deliver_mx(hosts, group, results)
+
+    def deliver_mx(self, hosts, messages, results):
+        error = None
+        for host in hosts:
+            try:
+                self.connect_mx(host)
+            except (SMTPException, socket_error), e:
+                error = e
+            else:
+                self.send_all(messages, results)
+                self.disconnect()
+                return
+        self.defer(messages, error, results)
+
     def send(self, messages):
         logger = getLogger("django_ztaskq_mailer")
         results = {
@@ -154,16 +361,10 @@ class MailSender(object):
         }
         retries = defaultdict(list)
         with self.lock:
-            try:
-                self.connect()
-            except SMTPException, e:
-                for message in messages:
-                    message.errors.append(e)
-                    message.retries += 1
-                    results['retry'].append(message)
+            if self.direct:
+                self.deliver_direct(messages, results)
             else:
-                for message in messages:
-                    self.send_message(message, results)
+                self.deliver(messages, results)
             while len(results['retry']) > 0:
                 message = results['retry'].pop()
                 if message.must_resend():
@@ -183,9 +384,22 @@ class MailSender(object):
                             message.mail_message.message().as_string(),
                         )
                     )
-            self.disconnect()
+                if get_setting('DEAD_LETTER'):
+                    self.store_dead_letters(results['failed'])
         return results
 
+    def store_dead_letters(self, messages):
+        try:
+            DeadLetter.objects.bulk_create([
+                DeadLetter.from_wrapper(m) for m in messages
+            ])
+        except Exception: # pylint: disable=W0703
+            getLogger("django_ztaskq_mailer").exception(
+                "Could not store %d failed message(s) as dead letters" % (
+                    len(messages),
+                )
+            )
+
 
 sender = MailSender()
 
@@ -195,12 +409,195 @@ def sendmail(messages):
     sender.send(messages)
 
 
+def enqueue(messages):
+    """Queues the messages, splitting them in tasks of at most
+    ``CHUNK_SIZE`` messages each
+    """
+    chunk_size = get_setting('CHUNK_SIZE')
+    for start in range(0, len(messages), chunk_size):
+        sendmail.async(messages[start:start + chunk_size])
+
+
+_buffers = local()
+
+
+def get_buffer():
+    """Returns the list the current thread is buffering messages into,
+    or ``None`` if it is not buffering
+    """
+    stack = getattr(_buffers, 'stack', None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+def get_buffering_depth():
+    """Returns how many buffers the current thread has started
+    and not stopped yet
+    """
+    return len(getattr(_buffers, 'stack', None) or [])
+
+
+def discard_buffering(depth):
+    """Throws away the buffers started after the current thread was
+    ``depth`` buffers deep, and the messages in them
+    """
+    if get_buffering_depth() > depth:
+        del _buffers.stack[depth:]
+
+
+def start_buffering():
+    if getattr(_buffers, 'stack', None) is None:
+        _buffers.stack = []
+    _buffers.stack.append([])
+
+
+def stop_buffering(discard=False):
+    """Stops the innermost buffering. Unless ``discard`` is set,
+    the buffered messages are passed on to the enclosing buffer
+    or, if there is none, queued
+    """
+    messages = _buffers.stack.pop()
+    if discard:
+        return
+    if _buffers.stack:
+        _buffers.stack[-1].extend(messages)
+    elif messages:
+        enqueue(messages)
+
+
+@contextmanager
+def buffered_mail():
+    """Holds back all the mail sent inside the block and queues it
+    when the block exits, or throws it away if the block raises.
+
+    Wrap it around a ``transaction.commit_on_success`` block to only send
+    the mail once the transaction has been committed.
+    """
+    start_buffering()
+    try:
+        yield
+    except:
+        stop_buffering(discard=True)
+        raise
+    else:
+        stop_buffering()
+
+
+class Dispatcher(object):
+    """Queues messages from a background thread, so that callers do not
+    wait for the messages to be pickled and pushed to the queue.
+    Messages handed over while the thread is busy are queued together.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.queue = Queue()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(
+                    target=self.run,
+                    name="django_ztaskq_mailer dispatcher"
+                )
+                self.thread.daemon = True
+                self.thread.start()
+
+    def put(self, messages):
+        self.start()
+        self.queue.put(messages)
+
+    def flush(self, timeout=None):
+        """Waits until all the messages handed over have been queued,
+        or at most ``timeout`` seconds. Returns whether they all were.
+        """
+        if timeout is None:
+            self.queue.join()
+            return True
+        deadline = time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def shutdown(self):
+        # The thread is a daemon, so whatever it did not queue yet
+        # would be lost when the process exits
+        if not self.flush(get_setting('FLUSH_TIMEOUT')):
+            getLogger("django_ztaskq_mailer").error(
+                "Exiting with %d batch(es) of messages not queued" % (
+                    self.queue.unfinished_tasks,
+                )
+            )
+
+    def dispatch(self, messages):
+        messages = list(messages)
+        batches = 1
+        chunk_size = get_setting('CHUNK_SIZE')
+        try:
+            while len(messages) < chunk_size:
+                try:
+                    messages.extend(self.queue.get_nowait())
+                except Empty:
+                    break
+                batches += 1
+            start = 0
+            try:
+                while start < len(messages):
+                    sendmail.async(messages[start:start + chunk_size])
+                    start += chunk_size
+            except Exception, e: # pylint: disable=W0703
+                # The caller was already told these were sent, so keep
+                # them where replay_deadletters can find them
+                lost = messages[start:]
+                getLogger("django_ztaskq_mailer").exception(
+                    "Could not queue %d message(s)" % len(lost)
+                )
+                for message in lost:
+                    message.errors.append(e)
+                if get_setting('DEAD_LETTER'):
+                    sender.store_dead_letters(lost)
+        finally:
+            for __ in range(batches):
+                self.queue.task_done()
+
+    def run(self):
+        while True:
+            self.dispatch(self.queue.get())
+
+
+dispatcher = Dispatcher()
+atexit.register(dispatcher.shutdown)
+
+
 class EmailBackend(BaseEmailBackend):
 
     def send_messages(self, messages):
-        sendmail.async([
-            MessageWrapper(m) for m in messages
-        ])
+        wrapped = [ MessageWrapper(m) for m in messages ]
+        buffer_ = get_buffer()
+        if buffer_ is not None:
+            buffer_.extend(wrapped)
+        else:
+            enqueue(wrapped)
+        return len(wrapped)
+
+    def asend_messages(self, messages):
+        """Like ``send_messages``, but returns straight away and leaves
+        the queueing to the dispatcher thread. Meant for code that must not
+        block, such as event loops or greenlets.
+        """
+        wrapped = [ MessageWrapper(m) for m in messages ]
+        buffer_ = get_buffer()
+        if buffer_ is not None:
+            buffer_.extend(wrapped)
+        elif wrapped:
+            dispatcher.put(wrapped)
+        return len(wrapped)
 
 
 def test_send(from_, to):
@@ -0,0 +1,77 @@
+"""Tells apart SMTP errors that are worth retrying from those that are not.
+
+Errors are classified as:
+
+``PERMANENT``
+    the server will never accept the message (``5xx`` replies, like an
+    unknown mailbox or a policy rejection)
+
+``THROTTLE``
+    the server is asking us to slow down (``421``, or an enhanced status
+    code such as ``4.7.x`` or ``4.4.5``)
+
+``TRANSIENT``
+    anything else: other ``4xx`` replies, dropped connections and errors
+    without a reply code
+"""
+import re
+from smtplib import SMTPResponseException, SMTPRecipientsRefused
+
+
+PERMANENT = 'permanent'
+TRANSIENT = 'transient'
+THROTTLE = 'throttle'
+
+# Enhanced status codes (RFC 3463) can only start the text of the reply
+ENHANCED_STATUS = re.compile(r'\s*([245])\.(\d{1,3})\.(\d{1,3})\b')
+
+THROTTLE_CODES = (421,)
+
+# Prefixes of the enhanced status codes (RFC 3463) asking us to back off:
+# policy and rate limiting (greylisting included), congestion,
+# server not accepting messages and too many recipients
+THROTTLE_STATUSES = ('4.7.', '4.4.5', '4.3.2', '4.5.3')
+
+
+def classify_reply(code, text=''):
+    """Classifies a SMTP reply given its code and text
+    """
+    match = ENHANCED_STATUS.match(text or '')
+    # An enhanced status code whose class disagrees with the reply code
+    # is not to be trusted
+    if match is not None and match.group(1) == str(code // 100):
+        status = '.'.join(match.groups())
+        if status[0] == '5':
+            return PERMANENT
+        for prefix in THROTTLE_STATUSES:
+            if status == prefix or (prefix.endswith('.') and
+                                    status.startswith(prefix)):
+                return THROTTLE
+        return TRANSIENT
+    if code in THROTTLE_CODES:
+        return THROTTLE
+    if 500 <= code < 600:
+        return PERMANENT
+    return TRANSIENT
+
+
+def classify(error):
+    """Classifies an exception raised while sending a message
+    """
+    if isinstance(error, SMTPRecipientsRefused):
+        recipients = error.recipients
+        if not isinstance(recipients, dict) or not recipients:
+            return TRANSIENT
+        outcomes = set([
+            classify_reply(code, text)
+            for code, text in recipients.values()
+        ])
+        # The message is only hopeless if every recipient refused it
+        if outcomes == set([PERMANENT]):
+            return PERMANENT
+        if THROTTLE in outcomes:
+            return THROTTLE
+        return TRANSIENT
+    if isinstance(error, SMTPResponseException):
+        return classify_reply(error.smtp_code, error.smtp_error)
+    return TRANSIENT
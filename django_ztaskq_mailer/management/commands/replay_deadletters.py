@@ -0,0 +1,137 @@
+from datetime import datetime
+from optparse import make_option
+from time import time, sleep
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import make_aware, get_default_timezone
+from ...backend import MessageWrapper, sendmail
+from ...models import DeadLetter
+
+
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            date = datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+        if settings.USE_TZ:
+            date = make_aware(date, get_default_timezone())
+        return date
+    raise CommandError("Invalid date: '%s'" % value)
+
+
+class Command(BaseCommand):
+    help = ("Puts the dead letters back in the mail queue, "
+            "in chunks of --chunk-size messages each")
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since', default=None,
+                    help="Only replay letters failed after this date"),
+        make_option('--until', dest='until', default=None,
+                    help="Only replay letters failed before this date"),
+        make_option('--from', dest='from_email', default=None,
+                    help="Only replay letters from this sender"),
+        make_option('--to', dest='recipient', default=None,
+                    help="Only replay letters whose recipients contain this"),
+        make_option('--error', dest='error', default=None,
+                    help="Only replay letters whose errors contain this"),
+        make_option('--limit', dest='limit', type='int', default=0,
+                    help="Replay at most this many letters"),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=500,
+                    help="Number of letters queued in each task"),
+        make_option('--rate', dest='rate', type='float', default=0,
+                    help="Maximum number of letters queued per second"),
+        make_option('--keep', dest='keep', action='store_true',
+                    default=False,
+                    help="Do not delete the letters once queued"),
+        make_option('--dry-run', dest='dry_run', action='store_true',
+                    default=False,
+                    help="Only count the letters that would be replayed"),
+    )
+
+    def get_queryset(self, options):
+        queryset = DeadLetter.objects.all()
+        if options['since']:
+            queryset = queryset.filter(created__gte=parse_date(
+                options['since']
+            ))
+        if options['until']:
+            queryset = queryset.filter(created__lt=parse_date(
+                options['until']
+            ))
+        if options['from_email']:
+            queryset = queryset.filter(
+                from_email__icontains=options['from_email']
+            )
+        if options['recipient']:
+            queryset = queryset.filter(
+                recipients__icontains=options['recipient']
+            )
+        if options['error']:
+            queryset = queryset.filter(errors__icontains=options['error'])
+        return queryset.only('pk', 'recipients', 'payload').order_by('pk')
+
+    def get_chunks(self, queryset, chunk_size, limit):
+        # We page on the primary key rather than with offsets, so that
+        # deleting the letters as we go does not shift the window
+        # and each chunk is an index lookup
+        last_pk = 0
+        count = 0
+        while not limit or count < limit:
+            size = chunk_size
+            if limit:
+                size = min(size, limit - count)
+            chunk = list(queryset.filter(pk__gt=last_pk)[:size])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+            count += len(chunk)
+            yield chunk
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        rate = options['rate']
+        verbosity = int(options.get('verbosity', 1))
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be a positive number")
+        if rate < 0:
+            raise CommandError("--rate must not be negative")
+        queryset = self.get_queryset(options)
+        if options['dry_run']:
+            count = queryset.count()
+            if options['limit']:
+                count = min(count, options['limit'])
+            self.stdout.write("%d letter(s) would be replayed\n" % count)
+            return
+        replayed = 0
+        for chunk in self.get_chunks(queryset, chunk_size, options['limit']):
+            started = time()
+            messages = []
+            pks = []
+            for letter in chunk:
+                try:
+                    message = MessageWrapper(letter.get_mail_message())
+                except Exception, e: # pylint: disable=W0703
+                    self.stderr.write(
+                        "Could not load dead letter %d: %s\n" % (letter.pk, e)
+                    )
+                else:
+                    message.envelope_recipients = letter.get_recipients()
+                    messages.append(message)
+                    pks.append(letter.pk)
+            if not messages:
+                continue
+            sendmail.async(messages)
+            if not options['keep']:
+                DeadLetter.objects.filter(pk__in=pks).delete()
+            replayed += len(messages)
+            if verbosity > 1:
+                self.stdout.write("Queued %d letter(s)\n" % replayed)
+            if rate:
+                wait = len(messages) / rate - (time() - started)
+                if wait > 0:
+                    sleep(wait)
+        self.stdout.write("%d letter(s) replayed\n" % replayed)
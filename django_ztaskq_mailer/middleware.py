@@ -0,0 +1,52 @@
+from django.core.signals import got_request_exception
+from .backend import (get_buffering_depth, discard_buffering,
+                      start_buffering, stop_buffering)
+
+
+class MailBufferMiddleware(object):
+    """Buffers the mail sent while processing a request and queues it,
+    chunked, once the response is ready. If the view raises the mail is
+    discarded.
+
+    Place it *before* ``django.middleware.transaction.TransactionMiddleware``
+    so that mail is only queued after the transaction has been committed.
+    """
+
+    # How many buffers deep the thread was when the request started
+    attribute = '_ztaskq_mailer_depth'
+
+    def process_request(self, request):
+        setattr(request, self.attribute, get_buffering_depth())
+        start_buffering()
+
+    def process_exception(self, request, exception):
+        discard_request_buffer(request)
+
+    def process_response(self, request, response):
+        depth = getattr(request, self.attribute, None)
+        if depth is not None:
+            setattr(request, self.attribute, None)
+            # Drop whatever was left behind by nested requests
+            # whose responses never made it back here
+            discard_buffering(depth + 1)
+            stop_buffering()
+        return response
+
+
+def discard_request_buffer(request, **kwargs):
+    """Throws away the buffer of ``request`` and the ones started after it,
+    but not those it was started into
+    """
+    attribute = MailBufferMiddleware.attribute
+    depth = getattr(request, attribute, None)
+    if depth is not None:
+        setattr(request, attribute, None)
+        discard_buffering(depth)
+
+
+# When a response middleware raises our process_response is skipped,
+# but this signal is still sent
+got_request_exception.connect(
+    discard_request_buffer,
+    dispatch_uid='django_ztaskq_mailer.middleware'
+)
@@ -1 +1,51 @@
-# Make this an application
+from base64 import b64encode, b64decode
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
+from django.db import models
+from django.utils.timezone import now
+
+
+class DeadLetter(models.Model):
+    """A message that could not be delivered even after all the retries.
+
+    The original ``EmailMessage`` is kept pickled in ``payload`` so that
+    it can be replayed later (see the ``replay_deadletters`` command),
+    while ``message`` and ``errors`` hold a human readable copy.
+    ``recipients`` lists, one per line, the addresses the message
+    could not be delivered to.
+    """
+
+    created = models.DateTimeField(default=now, db_index=True)
+    from_email = models.CharField(max_length=254)
+    recipients = models.TextField()
+    subject = models.CharField(max_length=255, blank=True)
+    retries = models.PositiveIntegerField(default=0)
+    errors = models.TextField(blank=True)
+    message = models.TextField()
+    payload = models.TextField()
+
+    class Meta:
+        ordering = ('pk',)
+
+    @classmethod
+    def from_wrapper(cls, wrapper):
+        mail_message = wrapper.mail_message
+        return cls(
+            from_email=(mail_message.from_email or '')[:254],
+            recipients="\n".join(wrapper.recipients()),
+            subject=(mail_message.subject or '')[:255],
+            retries=wrapper.retries,
+            errors="\n".join([ str(e) for e in wrapper.errors ]),
+            message=mail_message.message().as_string(),
+            payload=b64encode(dumps(mail_message, HIGHEST_PROTOCOL))
+        )
+
+    def get_recipients(self):
+        return self.recipients.splitlines()
+
+    def get_mail_message(self):
+        return loads(b64decode(str(self.payload)))
+
+    def __unicode__(self):
+        return u"%s to %s (%s)" % (self.from_email,
+                                   u", ".join(self.get_recipients()),
+                                   self.created)
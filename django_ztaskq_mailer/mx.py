@@ -0,0 +1,131 @@
+from time import time
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+from .utils import get_setting
+
+
+class DomainNotFound(Exception):
+    """The domain does not exist, so it can't receive mail
+    """
+
+    def __init__(self, domain, ttl=300):
+        self.domain = domain
+        self.ttl = ttl
+        super(DomainNotFound, self).__init__(domain, ttl)
+
+
+class DNSResolver(object):
+    """Looks up MX records in the DNS, using dnspython_.
+
+    Resolvers have a ``resolve(domain)`` method returning a list of
+    ``(preference, host)`` tuples and the number of seconds they can be
+    cached for. An empty list means that the domain has no MX records,
+    and ``DomainNotFound`` is raised for non-existent domains.
+
+    .. _dnspython: http://www.dnspython.org/
+    """
+
+    negative_ttl = 300
+
+    def __init__(self):
+        try:
+            import dns.resolver
+        except ImportError:
+            raise ImproperlyConfigured(
+                "Direct delivery needs dnspython to resolve MX records"
+            )
+        self.resolver = dns.resolver
+
+    def resolve(self, domain):
+        try:
+            answer = self.resolver.query(domain, 'MX')
+        except self.resolver.NXDOMAIN:
+            raise DomainNotFound(domain, self.negative_ttl)
+        except self.resolver.NoAnswer:
+            return [], self.negative_ttl
+        return [
+            (record.preference, record.exchange.to_text(omit_final_dot=True))
+            for record in answer
+        ], answer.rrset.ttl
+
+
+class StaticResolver(object):
+    """Resolves MX records from a dictionary mapping domains to lists of
+    ``(preference, host)`` tuples, which defaults to the ``MX_RECORDS``
+    setting. Domains that are not in it do not exist.
+    """
+
+    def __init__(self, records=None, ttl=3600):
+        if records is None:
+            records = get_setting('MX_RECORDS')
+        self.records = dict(
+            (domain.lower(), list(hosts))
+            for domain, hosts in records.items()
+        )
+        self.ttl = ttl
+
+    def resolve(self, domain):
+        try:
+            return list(self.records[domain]), self.ttl
+        except KeyError:
+            raise DomainNotFound(domain, self.ttl)
+
+
+def get_resolver():
+    path = get_setting('MX_RESOLVER')
+    module_name, __, class_name = path.rpartition('.')
+    try:
+        return getattr(import_module(module_name), class_name)()
+    except (ImportError, AttributeError, ValueError), e:
+        raise ImproperlyConfigured(
+            "Could not load MX resolver '%s': %s" % (path, e)
+        )
+
+
+class MXCache(object):
+    """Caches the mail exchangers of each domain for as long as their
+    records' TTL allows. Expired entries are dropped every
+    ``sweep_interval`` seconds.
+    """
+
+    def __init__(self, resolver, timer=time, sweep_interval=300):
+        self.resolver = resolver
+        self.timer = timer
+        self.sweep_interval = sweep_interval
+        self.entries = {}
+        self.next_sweep = timer() + sweep_interval
+
+    def sweep(self, now):
+        for domain, entry in self.entries.items():
+            if entry[0] <= now:
+                del self.entries[domain]
+        self.next_sweep = now + self.sweep_interval
+
+    def get_hosts(self, domain):
+        """Returns the hosts accepting mail for ``domain``, most preferred
+        first. The list is empty if the domain can't receive mail.
+        """
+        domain = domain.lower()
+        now = self.timer()
+        entry = self.entries.get(domain)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        try:
+            records, ttl = self.resolver.resolve(domain)
+        except DomainNotFound, e:
+            hosts, ttl = [], e.ttl
+        else:
+            if records:
+                # A single "." record is a null MX (RFC 7505)
+                hosts = [
+                    host for __, host in sorted(records)
+                    if host not in ('', '.')
+                ]
+            else:
+                # No MX records, the domain itself is the mail exchanger
+                # (RFC 5321, section 5.1)
+                hosts = [ domain ]
+        if now >= self.next_sweep:
+            self.sweep(now)
+        self.entries[domain] = (now + ttl, hosts)
+        return hosts
@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
+from socket import timeout as socket_timeout
+from StringIO import StringIO
+from cPickle import dumps, loads
 from smtplib import (SMTP, SMTP_SSL, SMTPException, SMTPConnectError,
                      SMTPHeloError, SMTPDataError, SMTPAuthenticationError,
-                     SMTPRecipientsRefused, SMTPSenderRefused)
+                     SMTPRecipientsRefused, SMTPSenderRefused,
+                     SMTPServerDisconnected)
 from mock import Mock, MagicMock, patch, call
 from unittest import TestCase
 from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
 from django.core.mail.message import EmailMessage
 from django.test import TestCase as DjangoTestCase
-from .backend import MessageWrapper, MalformedMessage, MailSender
+from .backend import (MessageWrapper, MalformedMessage, MailSender,
+                      Dispatcher, buffered_mail, dispatcher)
+from .middleware import MailBufferMiddleware
+from .models import DeadLetter
+from .classification import classify, PERMANENT, TRANSIENT, THROTTLE
+from .mx import MXCache, StaticResolver, DomainNotFound
 from .utils import get_setting
 
 
@@ -138,6 +148,234 @@ class MessageWrapperTest(TestCase):
         for error in message.errors:
             self.assertTrue(isinstance(error, SMTPDataError))
 
+    def test_send_permanent(self):
+        message = MessageWrapper(self.correct_email)
+        self.connection.sendmail.side_effect = SMTPDataError(
+            550,
+            "5.1.1 User unknown"
+        )
+        message.send(self.connection)
+        self.assertEqual(message.retries, 1)
+        self.assertEqual(message.outcome, PERMANENT)
+        self.assertEqual(message.must_resend(), False)
+
+    def test_send_throttle(self):
+        message = MessageWrapper(self.correct_email)
+        self.connection.sendmail.side_effect = SMTPDataError(
+            451,
+            "4.7.1 Please try again later"
+        )
+        message.send(self.connection)
+        message.send(self.connection)
+        self.assertEqual(message.retries, 2)
+        self.assertEqual(message.outcome, THROTTLE)
+        self.assertEqual(message.must_resend(), True)
+        self.assertEqual(message.resend_wait(), 600)
+
+    def test_split_by_domain(self):
+        email = EmailMessage(
+            'Test message',
+            'Just a test message',
+            'john@example.com',
+            to=['clint@example.com', u'Björn Borg <bjorn@example.org>'],
+            cc=['lee@EXAMPLE.com']
+        )
+        message = MessageWrapper(email)
+        parts = dict(message.split_by_domain())
+        self.assertEqual(sorted(parts.keys()), ['example.com', 'example.org'])
+        self.assertEqual(
+            parts['example.com'].recipients(),
+            ['clint@example.com', 'lee@EXAMPLE.com']
+        )
+        self.assertEqual(
+            parts['example.org'].recipients(),
+            [u'Björn Borg <bjorn@example.org>']
+        )
+        self.assertIs(
+            parts['example.org'].mail_message,
+            parts['example.com'].mail_message
+        )
+        self.assertEqual(email.extra_headers, {})
+        self.assertEqual(message.envelope_recipients, None)
+        parts['example.org'].send(self.connection)
+        self.assertEqual(
+            self.connection.sendmail.call_args[0][1],
+            ['=?utf-8?q?Bj=C3=B6rn_Borg?= <bjorn@example.org>']
+        )
+
+    def test_split_single_domain(self):
+        message = MessageWrapper(self.correct_email)
+        self.assertEqual(message.split_by_domain(), [
+            ('example.com', message)
+        ])
+
+    def test_old_pickle(self):
+        message = MessageWrapper(self.correct_email)
+        # Wrappers queued by earlier versions lack the newer attributes
+        del message.__dict__['retry_policies']
+        del message.__dict__['outcome']
+        del message.__dict__['envelope_recipients']
+        message = loads(dumps(message))
+        self.assertEqual(message.recipients(), ['clint@example.com'])
+        self.assertEqual(
+            DeadLetter.from_wrapper(message).recipients,
+            'clint@example.com'
+        )
+        message.send(self.faulty_connection)
+        self.assertEqual(message.outcome, TRANSIENT)
+        self.assertEqual(message.must_resend(), True)
+        self.assertEqual(message.resend_wait(), 30)
+
+
+class MXCacheTest(TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.resolver = StaticResolver({
+            'example.com': [(20, 'mx2.example.com'), (10, 'mx1.example.com')],
+            'example.org': [],
+            'example.net': [(0, '.')],
+        }, ttl=60)
+        self.resolver.resolve = Mock(wraps=self.resolver.resolve)
+        self.cache = MXCache(self.resolver, timer=lambda: self.now)
+
+    def test_preference(self):
+        self.assertEqual(
+            self.cache.get_hosts('Example.COM'),
+            ['mx1.example.com', 'mx2.example.com']
+        )
+
+    def test_implicit_mx(self):
+        self.assertEqual(self.cache.get_hosts('example.org'), ['example.org'])
+
+    def test_null_mx(self):
+        self.assertEqual(self.cache.get_hosts('example.net'), [])
+
+    def test_not_found(self):
+        with self.assertRaises(DomainNotFound):
+            self.resolver.resolve('nowhere.test')
+        self.assertEqual(self.cache.get_hosts('nowhere.test'), [])
+
+    def test_ttl(self):
+        self.cache.get_hosts('example.com')
+        self.now += 59
+        self.cache.get_hosts('example.com')
+        self.assertEqual(self.resolver.resolve.call_count, 1)
+        self.now += 1
+        self.cache.get_hosts('example.com')
+        self.assertEqual(self.resolver.resolve.call_count, 2)
+
+    def test_sweep(self):
+        self.cache.get_hosts('example.com')
+        self.cache.get_hosts('nowhere.test')
+        self.now += 200
+        self.cache.get_hosts('example.org')
+        self.assertEqual(len(self.cache.entries), 3)
+        self.now += 100
+        self.cache.get_hosts('example.net')
+        self.assertEqual(
+            sorted(self.cache.entries.keys()),
+            ['example.net']
+        )
+
+
+class ClassificationTest(TestCase):
+
+    def test_reply_codes(self):
+        self.assertEqual(classify(SMTPDataError(550, "No such user")),
+                         PERMANENT)
+        self.assertEqual(classify(SMTPDataError(451, "Local error")),
+                         TRANSIENT)
+        self.assertEqual(classify(SMTPDataError(421, "Too many connections")),
+                         THROTTLE)
+        self.assertEqual(classify(SMTPDataError(100, "Whatever")), TRANSIENT)
+
+    def test_enhanced_status_codes(self):
+        self.assertEqual(
+            classify(SMTPDataError(550, "5.7.1 Message rejected")),
+            PERMANENT
+        )
+        self.assertEqual(
+            classify(SMTPDataError(450, "4.2.0 Mailbox busy")),
+            TRANSIENT
+        )
+        self.assertEqual(
+            classify(SMTPDataError(450, "4.7.1 Greylisted, try later")),
+            THROTTLE
+        )
+        self.assertEqual(
+            classify(SMTPDataError(452, "4.5.3 Too many recipients")),
+            THROTTLE
+        )
+        self.assertEqual(
+            classify(SMTPDataError(451, "4.4.50 Something else")),
+            TRANSIENT
+        )
+        # An enhanced status code of a different class is ignored
+        self.assertEqual(
+            classify(SMTPDataError(550, "4.4.5 Insufficient resources")),
+            PERMANENT
+        )
+        self.assertEqual(
+            classify(SMTPDataError(452, "5.5.3 Too many recipients")),
+            TRANSIENT
+        )
+
+    def test_dotted_numbers_in_text(self):
+        self.assertEqual(
+            classify(SMTPDataError(
+                450,
+                "Greylisted, host 5.6.7.8 please retry later"
+            )),
+            TRANSIENT
+        )
+        self.assertEqual(
+            classify(SMTPDataError(451, "Local error, server version 5.0.1")),
+            TRANSIENT
+        )
+        self.assertEqual(
+            classify(SMTPDataError(
+                421,
+                "mx.example.com 4.7.0 is busy, from 10.0.0.1"
+            )),
+            THROTTLE
+        )
+        self.assertEqual(
+            classify(SMTPDataError(550, "Rejected by 4.3.2.1 policy")),
+            PERMANENT
+        )
+
+    def test_recipients_refused(self):
+        self.assertEqual(
+            classify(SMTPRecipientsRefused({
+                'a@example.com': (550, "5.1.1 User unknown"),
+                'b@example.com': (553, "5.1.3 Bad address"),
+            })),
+            PERMANENT
+        )
+        self.assertEqual(
+            classify(SMTPRecipientsRefused({
+                'a@example.com': (550, "5.1.1 User unknown"),
+                'b@example.com': (450, "4.2.1 Mailbox unavailable"),
+            })),
+            TRANSIENT
+        )
+        self.assertEqual(
+            classify(SMTPRecipientsRefused({
+                'a@example.com': (450, "4.7.1 Rate limited"),
+                'b@example.com': (450, "4.2.1 Mailbox unavailable"),
+            })),
+            THROTTLE
+        )
+        self.assertEqual(
+            classify(SMTPRecipientsRefused(['a@example.com'])),
+            TRANSIENT
+        )
+
+    def test_other_errors(self):
+        self.assertEqual(classify(SMTPServerDisconnected("Gone")), TRANSIENT)
+        self.assertEqual(classify(SMTPException("Whatever")), TRANSIENT)
+
 
 class SenderTest(DjangoTestCase):
 
@@ -181,6 +419,22 @@ class SenderTest(DjangoTestCase):
         'EMAIL_USE_SMTP_SSL': True
     })
 
+    direct_settings = base_settings.copy()
+    direct_settings.update({
+        'ZTASKQ_MAILER': dict(
+            base_settings['ZTASKQ_MAILER'],
+            DIRECT_DELIVERY=True,
+            MX_RESOLVER='django_ztaskq_mailer.mx.StaticResolver',
+            MX_RECORDS={
+                'example.com': [
+                    (20, 'mx2.example.com'),
+                    (10, 'mx1.example.com')
+                ],
+                'example.org': [],
+            }
+        )
+    })
+
     def setUp(self):
         self.dns_patcher = patch('django_ztaskq_mailer.backend.DNS_NAME')
         self.DNS_NAME = self.dns_patcher.start()
@@ -490,6 +744,431 @@ class SenderTest(DjangoTestCase):
         with self.settings(**self.normal_settings):
             self.assert_fail_sending()
 
+    def get_test_batch(self, size):
+        return [ self.get_test_email()[1] for __ in range(size) ]
+
+    def test_reconnect(self):
+        self.smtplib.mock_connection.sendmail.side_effect = [
+            None,
+            SMTPServerDisconnected("Connection unexpectedly closed"),
+            None,
+            None
+        ]
+        with self.settings(**self.normal_settings):
+            sender = MailSender()
+            batch = self.get_test_batch(4)
+            results = sender.send(batch)
+        self.assertEqual(self.smtplib.SMTP.call_count, 2)
+        self.assertEqual(self.smtplib.mock_connection.close.call_count, 1)
+        self.assertEqual(
+            self.smtplib.mock_connection.sendmail.call_count,
+            4
+        )
+        self.assertEqual(len(results['succesful']), 3)
+        self.assertEqual(results['retry'], [ batch[1] ])
+        self.assertEqual([ m.retries for m in batch ], [0, 1, 0, 0])
+        self.assertEqual(
+            self.sendmail.async.call_args_list,
+            [ call([ batch[1] ], ztaskq_delay=30) ]
+        )
+
+    def test_reconnect_shutdown(self):
+        self.smtplib.mock_connection.sendmail.side_effect = [
+            SMTPDataError(421, "Service shutting down"),
+            None
+        ]
+        with self.settings(**self.normal_settings):
+            sender = MailSender()
+            batch = self.get_test_batch(2)
+            results = sender.send(batch)
+        self.assertEqual(self.smtplib.SMTP.call_count, 2)
+        self.assertEqual(results['succesful'], [ batch[1] ])
+        self.assertEqual(results['retry'], [ batch[0] ])
+
+    def test_reconnect_limit(self):
+        self.smtplib.mock_connection.sendmail.side_effect = \
+            SMTPServerDisconnected("Connection unexpectedly closed")
+        settings = self.normal_settings.copy()
+        settings['ZTASKQ_MAILER'] = dict(settings['ZTASKQ_MAILER'],
+                                         MAX_RECONNECTS=1)
+        with self.settings(**settings):
+            sender = MailSender()
+            batch = self.get_test_batch(4)
+            results = sender.send(batch)
+        self.assertEqual(self.smtplib.SMTP.call_count, 2)
+        self.assertEqual(
+            self.smtplib.mock_connection.sendmail.call_count,
+            2
+        )
+        self.assertEqual(len(results['retry']), 4)
+        self.assertEqual([ m.retries for m in batch ], [1, 1, 1, 1])
+
+    def test_reconnect_fail(self):
+        self.smtplib.mock_connection.sendmail.side_effect = \
+            SMTPServerDisconnected("Connection unexpectedly closed")
+        self.smtplib.SMTP.side_effect = [
+            self.smtplib.mock_connection,
+            SMTPConnectError(421, "Try again later")
+        ]
+        with self.settings(**self.normal_settings):
+            sender = MailSender()
+            batch = self.get_test_batch(3)
+            results = sender.send(batch)
+        self.assertEqual(
+            self.smtplib.mock_connection.sendmail.call_count,
+            1
+        )
+        self.assertEqual(len(results['retry']), 3)
+        self.assertEqual([ m.retries for m in batch ], [1, 1, 1])
+        self.assertIsInstance(batch[2].errors[-1], SMTPConnectError)
+
+    def test_send_permanent(self):
+        self.smtplib.mock_connection.sendmail.side_effect = SMTPDataError(
+            550,
+            "5.1.1 User unknown"
+        )
+        with self.settings(**self.normal_settings):
+            sender = MailSender()
+            __, wrapped = self.get_test_email()
+            results = sender.send([ wrapped ])
+        self.assertEqual(results['failed'], [ wrapped ])
+        self.assertEqual(self.sendmail.async.call_count, 0)
+        self.assertEqual(DeadLetter.objects.count(), 1)
+
+    def test_send_throttle(self):
+        self.smtplib.mock_connection.sendmail.side_effect = SMTPDataError(
+            421,
+            "4.7.0 Too many messages, slow down"
+        )
+        settings = self.normal_settings.copy()
+        settings['ZTASKQ_MAILER'] = dict(
+            settings['ZTASKQ_MAILER'],
+            RETRY_POLICIES={'throttle': {'RETRY_STEP': 600}}
+        )
+        with self.settings(**settings):
+            sender = MailSender()
+            __, wrapped = self.get_test_email()
+            results = sender.send([ wrapped ])
+        self.assertEqual(results['retry'], [ wrapped ])
+        self.assertEqual(
+            self.sendmail.async.call_args_list,
+            [ call([ wrapped ], ztaskq_delay=600) ]
+        )
+
+    def test_send_permanent_partial_policies(self):
+        self.smtplib.mock_connection.sendmail.side_effect = SMTPDataError(
+            550,
+            "5.1.1 User unknown"
+        )
+        settings = self.normal_settings.copy()
+        settings['ZTASKQ_MAILER'] = dict(
+            settings['ZTASKQ_MAILER'],
+            RETRY_POLICIES={'throttle': {'RETRY_STEP': 600}}
+        )
+        with self.settings(**settings):
+            sender = MailSender()
+            __, wrapped = self.get_test_email()
+            results = sender.send([ wrapped ])
+        self.assertEqual(results['failed'], [ wrapped ])
+        self.assertEqual(self.sendmail.async.call_count, 0)
+
+    def test_send_permanent_override(self):
+        self.smtplib.mock_connection.sendmail.side_effect = SMTPDataError(
+            550,
+            "5.1.1 User unknown"
+        )
+        settings = self.normal_settings.copy()
+        settings['ZTASKQ_MAILER'] = dict(
+            settings['ZTASKQ_MAILER'],
+            RETRY_POLICIES={'permanent': {'MAX_RETRIES': 1}}
+        )
+        with self.settings(**settings):
+            sender = MailSender()
+            __, wrapped = self.get_test_email()
+            results = sender.send([ wrapped ])
+        self.assertEqual(results['retry'], [ wrapped ])
+        self.assertEqual(
+            self.sendmail.async.call_args_list,
+            [ call([ wrapped ], ztaskq_delay=30) ]
+        )
+
+    def test_connect_permanent(self):
+        self.smtplib.SMTP.side_effect = SMTPConnectError(554, "Go away")
+        with self.settings(**self.normal_settings):
+            sender = MailSender()
+            __, wrapped = self.get_test_email()
+            results = sender.send([ wrapped ])
+        self.assertEqual(wrapped.outcome, TRANSIENT)
+        self.assertEqual(results['retry'], [ wrapped ])
+
+    def get_direct_email(self, *recipients):
+        email = EmailMessage(
+            'Test message',
+            'Just a test message',
+            'john@example.com',
+            to=list(recipients)
+        )
+        return MessageWrapper(email)
+
+    def test_send_direct(self):
+        self.smtplib.mock_connection.has_extn.return_value = False
+        with self.settings(**self.direct_settings):
+            sender = MailSender()
+            results = sender.send([
+                self.get_direct_email('clint@example.com', 'lee@example.org',
+                                      'eli@example.com'),
+                self.get_direct_email('eli@example.com'),
+            ])
+        self.assertEqual(
+            sorted([ c[0] for c in self.smtplib.SMTP.call_args_list ]),
+            [
+                ('example.org', 25),
+                ('mx1.example.com', 25),
+            ]
+        )
+        self.assertEqual(
+            [ c[1] for c in self.smtplib.SMTP.call_args_list ],
+            [ {'local_hostname': 'localhost', 'timeout': 30} ] * 2
+        )
+        self.assertEqual(
+            sorted([ c[0][1] for c in
+                     self.smtplib.mock_connection.sendmail.call_args_list ]),
+            [
+                ['clint@example.com', 'eli@example.com'],
+                ['eli@example.com'],
+                ['lee@example.org'],
+            ]
+        )
+        self.assertEqual(self.smtplib.mock_connection.login.call_count, 0)
+        self.assertEqual(self.smtplib.mock_connection.starttls.call_count, 0)
+        self.assertEqual(self.smtplib.mock_connection.quit.call_count, 2)
+        self.assertEqual(len(results['succesful']), 3)
+        self.assertEqual(self.sendmail.async.call_count, 0)
+
+    def test_send_direct_same_headers(self):
+        self.smtplib.mock_connection.has_extn.return_value = False
+        with self.settings(**self.direct_settings):
+            sender = MailSender()
+            results = sender.send([
+                self.get_direct_email('clint@example.com', 'lee@example.org')
+            ])
+        self.assertEqual(len(results['succesful']), 2)
+        headers = []
+        for args, __ in self.smtplib.mock_connection.sendmail.call_args_list:
+            headers.append([
+                line for line in args[2].splitlines()
+                if line.startswith(('Message-ID:', 'Date:'))
+            ])
+        self.assertEqual(len(headers), 2)
+        self.assertEqual(len(headers[0]), 2)
+        self.assertEqual(headers[0], headers[1])
+
+    def test_send_direct_starttls(self):
+        self.smtplib.mock_connection.has_extn.return_value = True
+        with self.settings(**self.direct_settings):
+            sender = MailSender()
+            results = sender.send([
+                self.get_direct_email('clint@example.com')
+            ])
+        self.assertEqual(self.smtplib.mock_connection.starttls.call_count, 1)
+        self.assertEqual(self.smtplib.mock_connection.ehlo.call_count, 2)
+        self.assertEqual(len(results['succesful']), 1)
+
+    def test_send_direct_fallback(self):
+        self.smtplib.mock_connection.has_extn.return_value = False
+        self.smtplib.SMTP.side_effect = [
+            SMTPConnectError(421, "Too busy"),
+            self.smtplib.mock_connection
+        ]
+        with self.settings(**self.direct_settings):
+            sender = MailSender()
+            results = sender.send([
+                self.get_direct_email('clint@example.com')
+            ])
+        self.assertEqual(
+            self.smtplib.SMTP.call_args_list,
+            [
+                call('mx1.example.com', 25, local_hostname='localhost',
+                     timeout=30),
+                call('mx2.example.com', 25, local_hostname='localhost',
+                     timeout=30),
+            ]
+        )
+        self.assertEqual(len(results['succesful']), 1)
+
+    def test_send_direct_timeout(self):
+        self.smtplib.mock_connection.has_extn.return_value = False
+        self.smtplib.SMTP.side_effect = [
+            socket_timeout("timed out"),
+            self.smtplib.mock_connection
+        ]
+        settings = self.direct_settings.copy()
+        settings['ZTASKQ_MAILER'] = dict(settings['ZTASKQ_MAILER'],
+                                         MX_TIMEOUT=5)
+        with self.settings(**settings):
+            sender = MailSender()
+            results = sender.send([
+                self.get_direct_email('clint@example.com')
+            ])
+        self.assertEqual(
+            [ c[0][0] for c in self.smtplib.SMTP.call_args_list ],
+            ['mx1.example.com', 'mx2.example.com']
+        )
+        self.assertEqual(
+            self.smtplib.SMTP.call_args_list[0][1]['timeout'],
+            5
+        )
+        self.assertEqual(len(results['succesful']), 1)
+
+    def test_send_direct_unreachable(self):
+        self.smtplib.SMTP.side_effect = SMTPConnectError(421, "Too busy")
+        with self.settings(**self.direct_settings):
+            sender = MailSender()
+            wrapped = self.get_direct_email('clint@example.com')
+            results = sender.send([ wrapped ])
+        self.assertEqual(self.smtplib.SMTP.call_count, 2)
+        self.assertEqual(results['retry'], [ wrapped ])
+        self.assertEqual(wrapped.outcome, THROTTLE)
+
+    def test_send_direct_unknown_domain(self):
+        self.smtplib.mock_connection.has_extn.return_value = False
+        with self.settings(**self.direct_settings):
+            sender = MailSender()
+            results = sender.send([
+                self.get_direct_email('clint@example.com', 'bob@nowhere.test')
+            ])
+        self.assertEqual(len(results['succesful']), 1)
+        self.assertEqual(len(results['failed']), 1)
+        self.assertEqual(results['failed'][0].outcome, PERMANENT)
+        self.assertEqual(self.sendmail.async.call_count, 0)
+        letter = DeadLetter.objects.get()
+        self.assertEqual(letter.get_recipients(), ['bob@nowhere.test'])
+
+    def test_dead_letter(self):
+        self.smtplib.mock_connection.sendmail.side_effect = SMTPDataError(
+            100,
+            "Whatever"
+        )
+        with self.settings(**self.normal_settings):
+            self.assert_fail_sending()
+        self.assertEqual(DeadLetter.objects.count(), 1)
+        letter = DeadLetter.objects.get()
+        self.assertEqual(letter.from_email, 'john@example.com')
+        self.assertEqual(letter.recipients, 'clint@example.com')
+        self.assertEqual(letter.subject, 'Test message')
+        self.assertEqual(letter.retries, 3)
+        self.assertEqual(letter.errors, "\n".join(["(100, 'Whatever')"] * 3))
+        mail_message = letter.get_mail_message()
+        self.assertEqual(mail_message.to, ['clint@example.com'])
+        self.assertEqual(mail_message.body, 'Just a test message')
+
+    def test_dead_letter_disabled(self):
+        self.smtplib.mock_connection.sendmail.side_effect = SMTPDataError(
+            100,
+            "Whatever"
+        )
+        settings = self.normal_settings.copy()
+        settings['ZTASKQ_MAILER'] = dict(settings['ZTASKQ_MAILER'],
+                                         DEAD_LETTER=False)
+        with self.settings(**settings):
+            self.assert_fail_sending()
+        self.assertEqual(DeadLetter.objects.count(), 0)
+
+
+class ReplayDeadLettersTest(DjangoTestCase):
+
+    def setUp(self):
+        self.sendmail_patcher = patch(
+            'django_ztaskq_mailer.management.commands.'
+            'replay_deadletters.sendmail'
+        )
+        self.sendmail = self.sendmail_patcher.start()
+        self.sendmail.async = MagicMock()
+        for i in range(5):
+            email = EmailMessage(
+                'Test message %d' % i,
+                'Just a test message',
+                'john@example.com',
+                to=['user%d@example.com' % i]
+            )
+            DeadLetter.from_wrapper(MessageWrapper(email)).save()
+
+    def tearDown(self):
+        self.sendmail_patcher.stop()
+
+    def queued(self):
+        return [
+            [ m.mail_message.to[0] for m in c[0][0] ]
+            for c in self.sendmail.async.call_args_list
+        ]
+
+    def replay(self, **options):
+        stdout = StringIO()
+        call_command('replay_deadletters', stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_replay(self):
+        output = self.replay(chunk_size=2)
+        self.assertEqual(output, "5 letter(s) replayed\n")
+        self.assertEqual(
+            self.queued(),
+            [
+                ['user0@example.com', 'user1@example.com'],
+                ['user2@example.com', 'user3@example.com'],
+                ['user4@example.com'],
+            ]
+        )
+        self.assertEqual(DeadLetter.objects.count(), 0)
+
+    def test_replay_filter(self):
+        output = self.replay(recipient='user3', limit=3)
+        self.assertEqual(output, "1 letter(s) replayed\n")
+        self.assertEqual(self.queued(), [['user3@example.com']])
+        self.assertEqual(DeadLetter.objects.count(), 4)
+
+    def test_replay_limit_keep(self):
+        output = self.replay(chunk_size=2, limit=3, keep=True)
+        self.assertEqual(output, "3 letter(s) replayed\n")
+        self.assertEqual(
+            self.queued(),
+            [
+                ['user0@example.com', 'user1@example.com'],
+                ['user2@example.com'],
+            ]
+        )
+        self.assertEqual(DeadLetter.objects.count(), 5)
+
+    @patch('django_ztaskq_mailer.management.commands.'
+           'replay_deadletters.sleep')
+    def test_replay_dry_run(self, sleep):
+        output = self.replay(dry_run=True, rate=1)
+        self.assertEqual(output, "5 letter(s) would be replayed\n")
+        self.assertEqual(self.replay(dry_run=True, limit=3),
+                         "3 letter(s) would be replayed\n")
+        self.assertEqual(self.sendmail.async.call_count, 0)
+        self.assertEqual(sleep.call_count, 0)
+        self.assertEqual(DeadLetter.objects.count(), 5)
+
+    @patch('django_ztaskq_mailer.management.commands.'
+           'replay_deadletters.sleep')
+    def test_replay_unloadable(self, sleep):
+        DeadLetter.objects.update(payload='garbage')
+        stderr = StringIO()
+        output = self.replay(rate=1, stderr=stderr)
+        self.assertEqual(output, "0 letter(s) replayed\n")
+        self.assertEqual(len(stderr.getvalue().splitlines()), 5)
+        self.assertEqual(self.sendmail.async.call_count, 0)
+        self.assertEqual(sleep.call_count, 0)
+        self.assertEqual(DeadLetter.objects.count(), 5)
+
+    @patch('django_ztaskq_mailer.management.commands.'
+           'replay_deadletters.sleep')
+    def test_replay_rate(self, sleep):
+        self.replay(chunk_size=2, rate=1)
+        self.assertEqual(sleep.call_count, 3)
+        for args, __ in sleep.call_args_list:
+            self.assertTrue(0 < args[0] <= 2)
+
 
 class BackendTest(DjangoTestCase):
 
@@ -506,13 +1185,14 @@ class BackendTest(DjangoTestCase):
     def test_sendmail(self):
         with self.settings(EMAIL_BACKEND=self.BACKEND_NAME):
             from django.core.mail import send_mail
-            send_mail(
+            sent = send_mail(
                 'Subject here',
                 'Here is the message.',
                 'from@example.com',
                 ['to@example.com'],
                 fail_silently=False
             )
+            self.assertEqual(sent, 1)
             self.assertEqual(self.sendmail.async.call_count, 1)
             self.assertEqual(self.sendmail.async.call_args_list[-1][1], {})
             self.assertEqual(
@@ -527,3 +1207,245 @@ class BackendTest(DjangoTestCase):
             self.assertEqual(mail_message.to, ['to@example.com'])
             self.assertEqual(mail_message.subject, 'Subject here')
             self.assertEqual(mail_message.body, 'Here is the message.')
+
+    def test_asend_messages(self):
+        from django.core.mail import get_connection
+        email = EmailMessage(
+            'Subject here',
+            'Here is the message.',
+            'from@example.com',
+            ['to@example.com']
+        )
+        with self.settings(EMAIL_BACKEND=self.BACKEND_NAME):
+            self.assertEqual(get_connection().asend_messages([ email ]), 1)
+            dispatcher.flush()
+        self.assertEqual(self.sendmail.async.call_count, 1)
+        messages = self.sendmail.async.call_args_list[-1][0][0]
+        self.assertEqual(len(messages), 1)
+        self.assertIsInstance(messages[0], MessageWrapper)
+        self.assertIs(messages[0].mail_message, email)
+
+    def test_flush_timeout(self):
+        pending = Dispatcher()
+        pending.queue.put(['a'])
+        self.assertEqual(pending.flush(0.01), False)
+        pending.dispatch(pending.queue.get())
+        self.assertEqual(pending.flush(0.01), True)
+
+    def test_shutdown(self):
+        pending = Dispatcher()
+        logger = MagicMock(spec=['error'])
+        with patch('django_ztaskq_mailer.backend.getLogger',
+                   return_value=logger):
+            pending.put([ 'a' ])
+            pending.shutdown()
+            self.assertEqual(self.sendmail.async.call_args_list,
+                             [ call(['a']) ])
+            self.assertEqual(logger.error.call_count, 0)
+
+    def test_dispatch_failure(self):
+        pending = Dispatcher()
+        emails = [
+            MessageWrapper(EmailMessage(
+                'Subject here',
+                'Here is the message.',
+                'from@example.com',
+                [ recipient ]
+            ))
+            for recipient in ('a@example.com', 'b@example.com',
+                              'c@example.com')
+        ]
+        self.sendmail.async.side_effect = [None, IOError("Queue is down")]
+        logger = MagicMock(spec=['error', 'exception'])
+        with patch('django_ztaskq_mailer.backend.getLogger',
+                   return_value=logger):
+            with self.settings(ZTASKQ_MAILER={'CHUNK_SIZE': 2}):
+                pending.queue.put(emails)
+                pending.dispatch(pending.queue.get())
+        self.assertEqual(
+            self.sendmail.async.call_args_list,
+            [ call(emails[:2]), call(emails[2:]) ]
+        )
+        self.assertEqual(
+            logger.exception.call_args_list,
+            [ call("Could not queue 1 message(s)") ]
+        )
+        letter = DeadLetter.objects.get()
+        self.assertEqual(letter.get_recipients(), ['c@example.com'])
+        self.assertEqual(letter.errors, "Queue is down")
+        self.assertEqual(pending.queue.unfinished_tasks, 0)
+
+    def test_dispatch_batches(self):
+        pending = Dispatcher()
+        for recipient in ('a', 'b', 'c', 'd', 'e'):
+            pending.queue.put([ recipient ])
+        with self.settings(ZTASKQ_MAILER={'CHUNK_SIZE': 3}):
+            pending.dispatch(pending.queue.get())
+            self.assertEqual(
+                self.sendmail.async.call_args_list,
+                [ call(['a', 'b', 'c']) ]
+            )
+            pending.dispatch(pending.queue.get())
+        self.assertEqual(
+            self.sendmail.async.call_args_list,
+            [ call(['a', 'b', 'c']), call(['d', 'e']) ]
+        )
+        self.assertTrue(pending.queue.empty())
+        self.assertEqual(pending.queue.unfinished_tasks, 0)
+
+
+class BufferingTest(DjangoTestCase):
+
+    BACKEND_NAME = 'django_ztaskq_mailer.backend.EmailBackend'
+
+    def setUp(self):
+        self.sendmail_patcher = patch('django_ztaskq_mailer.backend.sendmail')
+        self.sendmail = self.sendmail_patcher.start()
+        self.sendmail.async = MagicMock()
+
+    def tearDown(self):
+        self.sendmail_patcher.stop()
+
+    def send(self, *recipients):
+        from django.core.mail import send_mail
+        for recipient in recipients:
+            send_mail('Subject here', 'Here is the message.',
+                      'from@example.com', [recipient])
+
+    def queued(self):
+        return [
+            [ m.mail_message.to[0] for m in c[0][0] ]
+            for c in self.sendmail.async.call_args_list
+        ]
+
+    def test_buffered(self):
+        with self.settings(EMAIL_BACKEND=self.BACKEND_NAME):
+            with buffered_mail():
+                self.send('a@example.com', 'b@example.com', 'c@example.com')
+                self.assertEqual(self.sendmail.async.call_count, 0)
+            self.assertEqual(
+                self.queued(),
+                [['a@example.com', 'b@example.com', 'c@example.com']]
+            )
+
+    def test_buffered_chunks(self):
+        with self.settings(EMAIL_BACKEND=self.BACKEND_NAME,
+                           ZTASKQ_MAILER={'CHUNK_SIZE': 2}):
+            with buffered_mail():
+                self.send('a@example.com', 'b@example.com', 'c@example.com')
+            self.assertEqual(
+                self.queued(),
+                [['a@example.com', 'b@example.com'], ['c@example.com']]
+            )
+
+    def test_buffered_rollback(self):
+        with self.settings(EMAIL_BACKEND=self.BACKEND_NAME):
+            with self.assertRaises(ValueError):
+                with buffered_mail():
+                    self.send('a@example.com')
+                    raise ValueError()
+            self.assertEqual(self.sendmail.async.call_count, 0)
+            self.send('b@example.com')
+            self.assertEqual(self.queued(), [['b@example.com']])
+
+    def test_buffered_nested(self):
+        with self.settings(EMAIL_BACKEND=self.BACKEND_NAME):
+            with buffered_mail():
+                self.send('a@example.com')
+                with buffered_mail():
+                    self.send('b@example.com')
+                try:
+                    with buffered_mail():
+                        self.send('c@example.com')
+                        raise ValueError()
+                except ValueError:
+                    pass
+                self.assertEqual(self.sendmail.async.call_count, 0)
+            self.assertEqual(
+                self.queued(),
+                [['a@example.com', 'b@example.com']]
+            )
+
+    def test_middleware(self):
+        middleware = MailBufferMiddleware()
+        request = Mock(spec=[])
+        response = Mock()
+        with self.settings(EMAIL_BACKEND=self.BACKEND_NAME):
+            middleware.process_request(request)
+            self.send('a@example.com', 'b@example.com')
+            self.assertEqual(self.sendmail.async.call_count, 0)
+            self.assertIs(
+                middleware.process_response(request, response),
+                response
+            )
+            self.assertEqual(
+                self.queued(),
+                [['a@example.com', 'b@example.com']]
+            )
+
+    def test_middleware_exception(self):
+        middleware = MailBufferMiddleware()
+        request = Mock(spec=[])
+        with self.settings(EMAIL_BACKEND=self.BACKEND_NAME):
+            middleware.process_request(request)
+            self.send('a@example.com')
+            middleware.process_exception(request, ValueError())
+            middleware.process_response(request, Mock())
+            self.assertEqual(self.sendmail.async.call_count, 0)
+            self.send('b@example.com')
+            self.assertEqual(self.queued(), [['b@example.com']])
+
+    def test_middleware_aborted_response(self):
+        from django.core.signals import got_request_exception
+        middleware = MailBufferMiddleware()
+        with self.settings(EMAIL_BACKEND=self.BACKEND_NAME):
+            aborted = Mock(spec=[])
+            middleware.process_request(aborted)
+            self.send('a@example.com')
+            # An earlier response middleware raised, so process_response
+            # is never called for this request, but the handler still
+            # signals the exception
+            got_request_exception.send(sender=None, request=aborted)
+            request = Mock(spec=[])
+            middleware.process_request(request)
+            self.send('b@example.com')
+            middleware.process_response(request, Mock())
+            self.assertEqual(self.queued(), [['b@example.com']])
+            self.send('c@example.com')
+            self.assertEqual(
+                self.queued(),
+                [['b@example.com'], ['c@example.com']]
+            )
+
+    def test_middleware_inside_buffered_mail(self):
+        middleware = MailBufferMiddleware()
+        with self.settings(EMAIL_BACKEND=self.BACKEND_NAME):
+            with buffered_mail():
+                self.send('a@example.com')
+                request = Mock(spec=[])
+                middleware.process_request(request)
+                self.send('b@example.com')
+                middleware.process_response(request, Mock())
+                failed = Mock(spec=[])
+                middleware.process_request(failed)
+                self.send('c@example.com')
+                middleware.process_exception(failed, ValueError())
+                middleware.process_response(failed, Mock())
+                self.assertEqual(self.sendmail.async.call_count, 0)
+            self.assertEqual(
+                self.queued(),
+                [['a@example.com', 'b@example.com']]
+            )
+
+    def test_middleware_nested_aborted_response(self):
+        middleware = MailBufferMiddleware()
+        with self.settings(EMAIL_BACKEND=self.BACKEND_NAME):
+            outer = Mock(spec=[])
+            middleware.process_request(outer)
+            self.send('a@example.com')
+            inner = Mock(spec=[])
+            middleware.process_request(inner)
+            self.send('b@example.com')
+            # The inner response never comes back to the middleware
+            middleware.process_response(outer, Mock())
+            self.assertEqual(self.queued(), [['a@example.com']])
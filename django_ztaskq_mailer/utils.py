@@ -4,7 +4,22 @@ from django.conf import settings
 default_settings = {
     'MAX_RETRIES': 5,
     'RETRY_STEP': 30,
-    'RETRY_BASE': 4
+    'RETRY_BASE': 4,
+    'DEAD_LETTER': True,
+    'CHUNK_SIZE': 100,
+    'MAX_RECONNECTS': 3,
+    # Override MAX_RETRIES, RETRY_STEP and RETRY_BASE by kind of error,
+    # see django_ztaskq_mailer.classification
+    'RETRY_POLICIES': {
+        'permanent': {'MAX_RETRIES': 0},
+        'throttle': {'RETRY_STEP': 300, 'RETRY_BASE': 2},
+    },
+    'DIRECT_DELIVERY': False,
+    'MX_RESOLVER': 'django_ztaskq_mailer.mx.DNSResolver',
+    'MX_RECORDS': {},
+    'MX_PORT': 25,
+    'MX_TIMEOUT': 30,
+    'FLUSH_TIMEOUT': 10
 }
 
 
@@ -30,5 +30,8 @@ setup(
         'Django',
         'django_ztaskq>=0.3.0',
         'mock'
-    ]
+    ],
+    extras_require={
+        'direct': ['dnspython'],
+    }
 )